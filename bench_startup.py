@@ -0,0 +1,53 @@
+"""Measures how long short lived task processes take to start.
+
+Usage: python bench_startup.py [runs]
+
+Each statement runs in a fresh interpreter and the best wall time of runs
+is reported, along with the cost on top of an interpreter that imports
+nothing. Timing the heavy modules on their own shows what importing task
+avoids until the database is first used.
+"""
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+BASELINE = 'pass'
+
+STATEMENTS = [
+    ('import sqlalchemy', 'import sqlalchemy'),
+    ('import sqlalchemy orm', 'import sqlalchemy.orm, '
+                              'sqlalchemy.ext.declarative'),
+    ('import task', 'import task'),
+    ('import task.sqlalchemy_api', 'import task.sqlalchemy_api'),
+    ('first db use', "import task; task.setup_db('sqlite://'); "
+                     "task.exists('bench')"),
+]
+
+
+def best_time(statement, runs):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement], cwd=ROOT)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    baseline = best_time(BASELINE, runs)
+    print('%-26s %8.1f ms' % ('interpreter', baseline * 1000))
+    for label, statement in STATEMENTS:
+        elapsed = best_time(statement, runs)
+        print('%-26s %8.1f ms  (+%.1f ms)' %
+              (label, elapsed * 1000, (elapsed - baseline) * 1000))
+
+
+if __name__ == '__main__':
+    main()
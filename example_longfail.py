@@ -13,16 +13,25 @@ def long_action(number, task_id, progress):
     print "Action %s Succeeded after %s tries" % (number, tries)
     return tries
 
+def run(task_id):
+    try:
+        task.run(task_id)
+    except task.Cancelled:
+        print "Task %s Cancelled" % task_id
+
+def is_done(task_id):
+    return task.is_complete(task_id) or task.is_cancelled(task_id)
+
 task.setup_db('sqlite://') # in memory db
 
 task_ids = []
 for i in xrange(10):
     task_ids.append(long_action(i))
 
-while not all(task.is_complete(task_id) for task_id in task_ids):
+while not all(is_done(task_id) for task_id in task_ids):
     task_id =  task.claim()
     if task_id:
-        eventlet.spawn_n(task.run, task_id)
+        eventlet.spawn_n(run, task_id)
     eventlet.sleep(0)
 
 for task_id in task_ids:
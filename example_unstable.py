@@ -29,7 +29,11 @@ def get_results(results):
         print "Phase %s Failed" % (ex.progress['phase'] + 1)
 
 while not task.is_complete(task_id):
-    results = task.run(task_id)
+    try:
+        results = task.run(task_id)
+    except task.Cancelled:
+        print "Task Cancelled"
+        break
     get_results(results)
-
-print "Task Completed"
+else:
+    print "Task Completed"
@@ -19,10 +19,17 @@ Stores tasks and allows them to be run again later.
 """
 
 
+import collections
+import copy
 import datetime
 import functools
+import hashlib
 import inspect
+import itertools
 import logging
+import pickle
+import sys
+import time
 import types
 import uuid
 
@@ -35,7 +42,23 @@ class Failure(Exception):
         self.progress = progress
 
 
+class Cancelled(Exception):
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+
+class NotComplete(Exception):
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+
 _now = datetime.datetime.utcnow
+_limits = {}
+_synced_limits = set()
+CANCEL_CHECK_INTERVAL = 1.0
+MEMO_CACHE_SECONDS = 5.0
+_MEMO_CACHE_SIZE = 1024
+_memo_cache = collections.OrderedDict()
 
 
 def inject_now_method(method):
@@ -44,12 +67,27 @@ def inject_now_method(method):
     db.inject_now_method(method)
 
 
-def _create(task_name, method, is_member, *args, **kwargs):
+def _create(task_name, method, is_member, args, kwargs,
+            idempotency_key=None, memo_key=None):
+    if idempotency_key is not None:
+        idempotency_key = str(idempotency_key)
+        try:
+            return db.task_find_by_key(task_name, idempotency_key)
+        except db.TaskNotFound:
+            pass
+    if task_name not in _synced_limits:
+        if task_name in _limits:
+            db.task_limit_set(task_name, *_limits[task_name])
+        else:
+            db.task_limit_clear(task_name)
+        _synced_limits.add(task_name)
     now = _now()
     task_id = str(uuid.uuid4())
     logging.debug('Creating task %s at %s', task_id, now)
     task = {'id': task_id,
             'task_name': task_name,
+            'idempotency_key': idempotency_key,
+            'memo_key': memo_key,
             'method': method,
             'is_member': is_member,
             'args': args,
@@ -58,7 +96,14 @@ def _create(task_name, method, is_member, *args, **kwargs):
             'updated_at': now,
             'is_active': False,
             'progress': None}
-    db.task_create(task)
+    try:
+        db.task_create(task)
+    except db.Duplicate:
+        if idempotency_key is None:
+            raise
+        # NOTE(vish): another producer created the task with this key
+        #             between the lookup and the insert
+        return db.task_find_by_key(task_name, idempotency_key)
     return task_id
 
 
@@ -79,8 +124,193 @@ def _is_member(func, args):
     return ismethod
 
 
-def ify(name=None, auto_update=True):
+def _normalize(value):
+    """Returns value with dicts and sets in a canonical order."""
+    if isinstance(value, dict):
+        return ('dict', sorted((_normalize(k), _normalize(v))
+                               for k, v in value.iteritems()))
+    if isinstance(value, (set, frozenset)):
+        return ('set', sorted(_normalize(item) for item in value))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, [_normalize(item) for item in value])
+    return value
+
+
+def _memo_key(args, kwargs):
+    """Returns a stable hash of the arguments of a call."""
+    data = pickle.dumps(_normalize((args, kwargs)), 2)
+    return hashlib.sha1(data).hexdigest()
+
+
+def _memo_find(task_name, memo_key, ttl):
+    """Get the id of a live task created with memo_key within ttl.
+
+    Hits in the in-process cache are trusted without asking the database
+    for MEMO_CACHE_SECONDS after they were looked up, so a task that was
+    destroyed or cancelled in the meantime may still be returned."""
+    created_after = None
+    if ttl is not None:
+        created_after = _now() - datetime.timedelta(seconds=ttl)
+    cache_key = (task_name, memo_key)
+    cached = _memo_cache.pop(cache_key, None)
+    if cached is not None:
+        task_id, created_at, cached_until = cached
+        if ((not created_after or created_at >= created_after) and
+            time.time() < cached_until):
+            _memo_cache[cache_key] = cached
+            return task_id
+    try:
+        task_id, created_at = db.task_find_memo(task_name, memo_key,
+                                                created_after)
+    except db.TaskNotFound:
+        return None
+    _memo_remember(cache_key, task_id, created_at)
+    return task_id
+
+
+def _memo_remember(cache_key, task_id, created_at):
+    """Cache a memoized task id, dropping the least recently used."""
+    _memo_cache[cache_key] = (task_id, created_at,
+                              time.time() + MEMO_CACHE_SECONDS)
+    while len(_memo_cache) > _MEMO_CACHE_SIZE:
+        _memo_cache.popitem(last=False)
+
+
+_REPLACE = 'replace'
+_DICT = 'dict'
+_SET = 'set'
+
+
+def _diff(old, new):
+    """Returns a delta that turns old into new when passed to _patch."""
+    if type(old) is not type(new):
+        return (_REPLACE, new)
+    if isinstance(new, dict):
+        changed = {}
+        for key, value in new.iteritems():
+            if key not in old:
+                changed[key] = (_REPLACE, value)
+            elif old[key] != value:
+                changed[key] = _diff(old[key], value)
+        removed = [key for key in old if key not in new]
+        return (_DICT, changed, removed)
+    if isinstance(new, (set, frozenset)):
+        return (_SET, new - old, old - new)
+    return (_REPLACE, new)
+
+
+def _patch(value, delta):
+    """Applies a delta from _diff to value and returns the result."""
+    kind = delta[0]
+    if kind == _DICT:
+        _kind, changed, removed = delta
+        for key in removed:
+            del value[key]
+        for key, item in changed.iteritems():
+            value[key] = _patch(value.get(key), item)
+        return value
+    if kind == _SET:
+        _kind, added, removed = delta
+        if isinstance(value, frozenset):
+            return (value | added) - removed
+        value |= added
+        value -= removed
+        return value
+    return delta[1]
+
+
+def _checkpoint(task_id, last, progress, compact_every):
+    """Record progress as a delta against last.
+
+    Writes a full snapshot once compact_every deltas have piled up.
+
+    :returns: last brought up to date with progress, to diff the next
+              yield against"""
+    delta = _diff(last, progress)
+    count = db.task_progress_append(task_id, delta)
+    logging.debug('Recorded delta %s for task %s', count, task_id)
+    # NOTE(vish): only the changed parts are copied into last, so the
+    #             generator can keep mutating its progress in place
+    last = _patch(last, copy.deepcopy(delta))
+    if count >= compact_every:
+        update(task_id, last)
+    return last
+
+
+class _CancelCheck(object):
+    """Polls the cancel flag of a task at most every CANCEL_CHECK_INTERVAL
+    seconds, so long running generators don't query on every yield."""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.next_check = 0
+
+    def __call__(self):
+        now = time.time()
+        if now < self.next_check:
+            return False
+        self.next_check = now + CANCEL_CHECK_INTERVAL
+        return db.task_cancelled(self.task_id)
+
+
+def _stop_cancelled(task_id):
+    """Release a cancelled task that was stopped between yields."""
+    values = {}
+    values['updated_at'] = _now()
+    values['is_active'] = False
+    db.task_update(task_id, values)
+    logging.debug('Stopped cancelled task %s', task_id)
+
+
+def ify(name=None, auto_update=True, delta_progress=False, compact_every=50,
+        max_concurrency=None, rate=None, dedupe_key=None, memoize=False,
+        ttl=None):
+    """Turns the decorated method into a task.
+
+    If delta_progress is set, each progress yielded by a generator task is
+    stored as a small delta against the previous one instead of rewriting
+    the whole object. Changes to dicts and sets are tracked key by key.
+    Deltas are folded into a full snapshot every compact_every yields and
+    when the task finishes, and run() rebuilds the latest progress from
+    the snapshot and any outstanding deltas. Only the changes are copied
+    and written, but finding them still compares the whole progress
+    object on every yield, so CPU per yield grows with its size.
+
+    If max_concurrency or rate is set, claim() skips tasks with this name
+    while max_concurrency of them are active or while more than rate
+    tasks per second have been claimed. The limits are stored in the
+    database when a process first creates a task with this name, with the
+    active count seeded from the tasks already running. Likewise, a name
+    with no limits has any stored limits removed at that point, so
+    dropping max_concurrency and rate takes effect once a task is next
+    created.
+
+    Calls may pass idempotency_key to make enqueueing idempotent: a second
+    call with the same key returns the id of the existing task instead of
+    creating a new one. Deleting the task frees its key. If dedupe_key is
+    set, it is called with the arguments of each call to compute the key
+    when none is passed.
+
+    If memoize is set, a call with the same arguments as an existing task
+    created in the last ttl seconds, or ever if ttl is None, returns the id
+    of that task instead of creating new work. Lookups are cached in
+    process and trusted for MEMO_CACHE_SECONDS, so for that long a task
+    destroyed or cancelled since may still be returned.
+
+    The wrapped method also gets a map(iterable, chunk_size) method that
+    creates one task per chunk of items. It only works for module level
+    methods that return their result. Each chunk task calls the method
+    once per item, like a direct call, and tracks its results as delta
+    progress so a retry resumes with the first unfinished item. map
+    returns the list of chunk task ids to pass to gather.
+
+    A generator task that is cancelled while it runs stops at the next
+    yield once the flag is seen. The flag is polled at most every
+    CANCEL_CHECK_INTERVAL seconds."""
     def wrapper(func):
+        if max_concurrency is not None or rate is not None:
+            _limits[name or func.__name__] = (max_concurrency, rate)
+
         @functools.wraps(func)
         def wrapped(*args, **kwargs):
             if 'task_id' in kwargs:
@@ -103,16 +333,30 @@ def ify(name=None, auto_update=True):
                     return rv
 
                 def gen():
+                    if delta_progress:
+                        last = copy.deepcopy(progress)
+                    cancel_requested = _CancelCheck(task_id)
                     try:
                         for orig_rv in rv:
-                            update(task_id, orig_rv)
+                            if delta_progress:
+                                last = _checkpoint(task_id, last, orig_rv,
+                                                   compact_every)
+                            else:
+                                update(task_id, orig_rv)
                             yield orig_rv
+                            if cancel_requested():
+                                rv.close()
+                                _stop_cancelled(task_id)
+                                return
                     except Failure as ex:
                         fail(task_id, ex.progress)
                         yield ex.progress
+                        return
                     except Exception as ex:
                         fail(task_id, None)
                         raise StopIteration
+                    if delta_progress:
+                        update(task_id, last)
                     finish(task_id)
 
                 return gen()
@@ -125,18 +369,121 @@ def ify(name=None, auto_update=True):
                 else:
                     method = wrapped
                     is_member = False
-                task_id = _create(task_name, method, is_member,
-                                  *args, **kwargs)
+                idempotency_key = kwargs.pop('idempotency_key', None)
+                if idempotency_key is None and dedupe_key:
+                    idempotency_key = dedupe_key(*args, **kwargs)
+                memo_key = None
+                if memoize:
+                    memo_key = _memo_key(args, kwargs)
+                    task_id = _memo_find(task_name, memo_key, ttl)
+                    if task_id:
+                        return task_id
+                task_id = _create(task_name, method, is_member, args, kwargs,
+                                  idempotency_key, memo_key)
+                if memoize:
+                    _memo_remember((task_name, memo_key), task_id, _now())
                 return task_id
+
+        def map_chunks(iterable, chunk_size=100, idempotency_key=None):
+            return _map(wrapped, name or func.__name__, iterable, chunk_size,
+                        idempotency_key)
+
+        wrapped.func = func
+        wrapped.map = map_chunks
         return wrapped
     return wrapper
 
 
+@ify(delta_progress=True)
+def _map_chunk(target, items, task_id, progress):
+    """Runs target on each item in a chunk, keeping results by index."""
+    results = progress or {}
+    for index in xrange(len(results), len(items)):
+        try:
+            results[index] = target.func(items[index], task_id=task_id,
+                                         progress=None)
+        except Failure:
+            raise Failure(results)
+        yield results
+
+
+def _map(target, task_name, iterable, chunk_size, idempotency_key=None):
+    """Creates a task for each chunk_size items taken from iterable.
+
+    Chunks get idempotency keys derived from idempotency_key, so retrying
+    the whole map does not create the chunks again."""
+    func = target.func
+    if inspect.isgeneratorfunction(func):
+        raise TypeError('Cannot map %s: map needs a task that returns its '
+                        'result, not a generator' % func.__name__)
+    module = sys.modules.get(func.__module__)
+    if getattr(module, func.__name__, None) is not target:
+        # NOTE(vish): chunks store target by reference, which only works
+        #             for tasks defined at module level
+        raise TypeError('Cannot map %s: map needs a module level task, '
+                        'not a method' % func.__name__)
+    task_ids = []
+    iterator = iter(iterable)
+    while True:
+        items = list(itertools.islice(iterator, chunk_size))
+        if not items:
+            break
+        key = None
+        if idempotency_key is not None:
+            key = '%s:%s' % (idempotency_key, len(task_ids))
+        task_ids.append(_create(task_name, _map_chunk, False,
+                                (target, items), {}, key))
+    return task_ids
+
+
+def gather(task_ids):
+    """Yield the results of a map in order, one chunk at a time.
+
+    Raises NotComplete when it reaches a chunk that has not finished."""
+    for task_id in task_ids:
+        task = db.task_get(task_id)
+        if task['completed_at'] is None:
+            raise NotComplete(task_id)
+        results = _load_progress(task)
+        for index in xrange(len(results)):
+            yield results[index]
+
+
 def get(task_id):
     """Get task from id."""
     return db.task_get(task_id)
 
 
+def _load_progress(task):
+    """Rebuild the latest progress from the snapshot and its deltas."""
+    progress = task['progress']
+    if task['progress_deltas']:
+        for delta in db.task_progress_deltas(task['id']):
+            progress = _patch(progress, delta)
+    return progress
+
+
+def get_progress(task_id):
+    """Get the latest progress for task id."""
+    return _load_progress(db.task_get(task_id))
+
+
+def query(task_name=None, state=None, created_before=None,
+          created_after=None, updated_before=None, columns=None,
+          batch_size=1000):
+    """Iterate over tasks matching all of the given filters.
+
+    state is one of 'pending', 'active', 'failed' (run at least once and
+    not active) or 'complete'. Tasks are yielded in id order as dicts of
+    columns, by default everything but the pickled ones, and are fetched
+    from the database batch_size at a time as the iterator advances."""
+    return db.task_query(columns=columns, batch_size=batch_size,
+                         task_name=task_name, state=state,
+                         created_before=created_before,
+                         created_after=created_after,
+                         updated_before=updated_before)
+
+
 def claim(task_name=None):
     """Get a free task_id if available optionally by task_name."""
     try:
@@ -157,14 +504,25 @@ def run(task_id):
 
     Underlying method will receive two kwargs:
         task_id = id of the current task for updating
-        progress = last progress passed to task_update"""
+        progress = last progress passed to task_update
+
+    Cancelled tasks are not run and raise Cancelled instead, since they
+    will never complete."""
     task = db.task_get(task_id)
+    if task['cancelled_at']:
+        logging.debug('Not running cancelled task %s', task_id)
+        if task['is_active']:
+            # NOTE(vish): cancelled after it was claimed, so give back the
+            #             claim and its limit slot
+            _stop_cancelled(task_id)
+        raise Cancelled(task_id)
     if task['is_member']:
         method = getattr(task['args'][0], task['method'])
     else:
         method = task['method']
+    progress = _load_progress(task)
     db.task_start(task_id)
-    return method(task_id=task['id'], progress=task['progress'],
+    return method(task_id=task['id'], progress=progress,
                   *task['args'], **task['kwargs'])
 
 
@@ -200,6 +558,75 @@ def finish(task_id):
     logging.debug('Finished task %s', task_id)
 
 
+def _update_many(values, task_ids, batch_size, filters, **extra):
+    if task_ids is None and not any(filters.values()):
+        raise ValueError('Pass task_ids or at least one filter')
+    if task_ids is not None:
+        task_ids = list(task_ids)
+    filters.update(extra)
+    return db.task_update_many(values, task_ids, batch_size, **filters)
+
+
+def finish_many(task_ids=None, batch_size=1000, **filters):
+    """Mark the tasks in task_ids and/or matching filters completed.
+
+    Filters are the same as for query. Tasks are changed batch_size at a
+    time, one transaction per batch.
+
+    :returns: number of tasks finished"""
+    now = _now()
+    values = {'updated_at': now,
+              'completed_at': now,
+              'is_active': False}
+    return _update_many(values, task_ids, batch_size, filters,
+                        completed=False)
+
+
+def fail_many(task_ids=None, batch_size=1000, **filters):
+    """Fail the incomplete tasks in task_ids and/or matching filters.
+
+    :returns: number of tasks failed"""
+    values = {'updated_at': _now(),
+              'is_active': False}
+    return _update_many(values, task_ids, batch_size, filters,
+                        completed=False)
+
+
+def destroy_many(task_ids=None, batch_size=1000, **filters):
+    """Delete the tasks in task_ids and/or matching filters.
+
+    Idempotency keys of deleted tasks can be used again.
+
+    :returns: number of tasks deleted"""
+    now = _now()
+    values = {'updated_at': now,
+              'deleted_at': now,
+              'deleted': True,
+              'idempotency_key': None,
+              'is_active': False}
+    return _update_many(values, task_ids, batch_size, filters)
+
+
+def requeue(task_ids=None, batch_size=1000, **filters):
+    """Make the tasks in task_ids and/or matching filters pending again.
+
+    Attempts and cancellation are reset and completed tasks will run
+    again. Progress is kept, so tasks resume where they left off. Tasks
+    that are running are left alone unless state='active' is passed,
+    since another worker could otherwise claim them while they run.
+
+    :returns: number of tasks requeued"""
+    values = {'updated_at': _now(),
+              'completed_at': None,
+              'cancelled_at': None,
+              'attempts': 0,
+              'is_active': False}
+    extra = {}
+    if filters.get('state') != 'active':
+        extra['active'] = False
+    return _update_many(values, task_ids, batch_size, filters, **extra)
+
+
 def is_active(task_id):
     """True if the task is active."""
     try:
@@ -208,6 +635,25 @@ def is_active(task_id):
         return False
 
 
+def cancel(task_id):
+    """Cancel the task.
+
+    Pending tasks will never be claimed or run, and a running generator
+    task stops at one of its next yields.
+
+    :returns: True if the task was cancelled, False if it was already
+              complete or cancelled"""
+    cancelled = db.task_cancel(task_id)
+    if cancelled:
+        logging.debug('Cancelled task %s', task_id)
+    return cancelled
+
+
+def is_cancelled(task_id):
+    """True if the task has been cancelled."""
+    return db.task_cancelled(task_id)
+
+
 def is_complete(task_id):
     """Completed if the task is done."""
     try:
@@ -227,4 +673,6 @@ def exists(task_id):
 
 def setup_db(sql_connection='sqlite:///task.sqlite'):
     """True if the task exists."""
+    _synced_limits.clear()
+    _memo_cache.clear()
     db.connect(sql_connection)
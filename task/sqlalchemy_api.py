@@ -0,0 +1,690 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 Vishvananda Ishaya
+# Copyright 2011 Openstack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+SQLAlchemy code for storing tasks.
+
+Imported by task.db the first time the database is used.
+
+Some portions borrowed Openstack Compute.
+"""
+
+from sqlalchemy import exc, func, orm, create_engine, select
+from sqlalchemy import Boolean, Column, DateTime, Float, Integer, PickleType
+from sqlalchemy import String, UniqueConstraint
+from sqlalchemy.engine import reflection
+from sqlalchemy.ext import declarative
+
+import db
+
+
+SCHEMA_VERSION = 2
+
+
+def _now():
+    return db._now()
+
+
+_ENGINE = None
+_MAKER = None
+
+
+def reset():
+    """Drop the engine so the next session uses the new connection."""
+    global _ENGINE
+    global _MAKER
+    _ENGINE = None
+    _MAKER = None
+
+
+def get_session(autocommit=True, expire_on_commit=False):
+    """Helper method to grab session"""
+    global _ENGINE
+    global _MAKER
+    if not _MAKER:
+        if not _ENGINE:
+            kwargs = {'pool_recycle': 3600,
+                      'echo': False}
+
+            _ENGINE = create_engine(db._SQL_CONNECTION,
+                                    **kwargs)
+            _sync_schema(_ENGINE)
+        _MAKER = (orm.sessionmaker(bind=_ENGINE,
+                                   autocommit=autocommit,
+                                   expire_on_commit=expire_on_commit))
+    session = _MAKER()
+    return session
+
+
+def _schema_version(engine):
+    """Get the recorded schema version or None if there is none."""
+    try:
+        return engine.execute(select([func.max(SchemaVersion.version)])).\
+                      scalar()
+    except exc.DBAPIError:
+        return None
+
+
+def _sync_schema(engine):
+    """Create or upgrade the tables unless the schema is already current."""
+    version = _schema_version(engine)
+    if version is not None and version >= SCHEMA_VERSION:
+        return
+    if version is None and engine.has_table(Task.__tablename__):
+        # NOTE(vish): the tables predate the schema version
+        version = 0
+    try:
+        BASE.metadata.create_all(engine)
+    except exc.DBAPIError:
+        # NOTE(vish): another process created some of the tables first
+        BASE.metadata.create_all(engine)
+    if version is not None:
+        for step, upgrade in _UPGRADES:
+            if step > version:
+                upgrade(engine)
+    try:
+        engine.execute(SchemaVersion.__table__.insert(),
+                       version=SCHEMA_VERSION)
+    except exc.IntegrityError:
+        # NOTE(vish): another process recorded the version first
+        pass
+
+
+def _column_names(engine, table_name):
+    inspector = reflection.Inspector.from_engine(engine)
+    return set(column['name'] for column in inspector.get_columns(table_name))
+
+
+def _index_names(engine, table_name):
+    inspector = reflection.Inspector.from_engine(engine)
+    return set(index['name'] for index in inspector.get_indexes(table_name))
+
+
+def _add_columns(engine, table, names):
+    """Add the named columns of table that the database is missing."""
+    for name in names:
+        if name in _column_names(engine, table.name):
+            continue
+        column_type = table.c[name].type.compile(dialect=engine.dialect)
+        try:
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                           (table.name, name, column_type))
+        except exc.DBAPIError:
+            # NOTE(vish): another process may have added it first
+            if name not in _column_names(engine, table.name):
+                raise
+
+
+def _add_index(engine, table_name, name, columns, unique=False):
+    """Create an index unless the database already has one called name."""
+    if name in _index_names(engine, table_name):
+        return
+    try:
+        engine.execute('CREATE %sINDEX %s ON %s (%s)' %
+                       ('UNIQUE ' if unique else '', name, table_name,
+                        ', '.join(columns)))
+    except exc.DBAPIError:
+        if name not in _index_names(engine, table_name):
+            raise
+
+
+def _upgrade_to_1(engine):
+    """Add the task columns that were added before versioning."""
+    tasks = Task.__table__
+    _add_columns(engine, tasks,
+                 ['progress_deltas', 'idempotency_key', 'memo_key'])
+    engine.execute(tasks.update().
+                   where(tasks.c.progress_deltas == None).
+                   values(progress_deltas=0))
+    _add_index(engine, tasks.name, 'uniq_tasks_idempotency_key',
+               ['task_name', 'idempotency_key'], unique=True)
+    _add_index(engine, tasks.name, 'ix_tasks_memo_key', ['memo_key'])
+
+
+def _upgrade_to_2(engine):
+    """Add the cancellation flag."""
+    _add_columns(engine, Task.__table__, ['cancelled_at'])
+
+
+# NOTE(vish): (version, upgrade) pairs, run in order for every version
+#             newer than the one recorded in the database
+_UPGRADES = [(1, _upgrade_to_1),
+             (2, _upgrade_to_2)]
+
+
+BASE = declarative.declarative_base()
+
+
+class SchemaVersion(BASE):
+    """Records the schema version the tables were created with."""
+    __tablename__ = 'task_schema'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+    __table_initialized__ = False
+    version = Column(Integer, primary_key=True, autoincrement=False)
+
+
+class Task(BASE):
+    """Represents a running service on a host."""
+    __tablename__ = 'tasks'
+    __table_args__ = (UniqueConstraint('task_name', 'idempotency_key'),
+                      {'mysql_engine': 'InnoDB'})
+    __table_initialized__ = False
+    created_at = Column(DateTime, default=_now)
+    updated_at = Column(DateTime, onupdate=_now)
+    deleted_at = Column(DateTime)
+    deleted = Column(Boolean, default=False)
+    id = Column(String(255), primary_key=True)
+    task_name = Column(String(255))
+    idempotency_key = Column(String(255))
+    memo_key = Column(String(40), index=True)
+    is_member = Column(Boolean)
+    is_active = Column(Boolean, default=True)
+    completed_at = Column(DateTime)
+    cancelled_at = Column(DateTime)
+    attempts = Column(Integer, default=0)
+    method = Column(PickleType)
+    progress = Column(PickleType)
+    progress_deltas = Column(Integer, default=0)
+    args = Column(PickleType)
+    kwargs = Column(PickleType)
+
+    def save(self, session=None):
+        """Save this object."""
+        if not session:
+            session = get_session()
+        session.add(self)
+        try:
+            session.flush()
+        except exc.IntegrityError, e:
+            message = str(e).lower()
+            if 'unique' in message or 'duplicate' in message:
+                raise db.Duplicate(str(e))
+            else:
+                raise
+
+    def delete(self, session=None):
+        """Delete this object."""
+        self.deleted = True
+        self.deleted_at = _now()
+        # NOTE(vish): free the key so it can be used for a new task
+        self.idempotency_key = None
+        self.save(session=session)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __iter__(self):
+        self._i = iter(orm.object_mapper(self).columns)
+        return self
+
+    def next(self):
+        n = self._i.next().name
+        return n, getattr(self, n)
+
+    def update(self, values):
+        columns = orm.object_mapper(self).columns
+        for key, value in values.iteritems():
+            if key in columns:
+                setattr(self, key, value)
+
+    def iteritems(self):
+        """Make the model object behave like a dict.
+
+        Includes attributes from joins."""
+        local = dict(self)
+        joined = dict([(k, v) for k, v in self.__dict__.iteritems()
+                      if not k[0] == '_'])
+        local.update(joined)
+        return local.iteritems()
+
+
+class TaskProgress(BASE):
+    """Represents a progress delta recorded on top of Task.progress."""
+    __tablename__ = 'task_progress'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+    __table_initialized__ = False
+    task_id = Column(String(255), primary_key=True)
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    created_at = Column(DateTime, default=_now)
+    delta = Column(PickleType)
+
+
+class TaskLimit(BASE):
+    """Represents the claim limits and counters for a task name."""
+    __tablename__ = 'task_limits'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+    __table_initialized__ = False
+    task_name = Column(String(255), primary_key=True)
+    max_concurrency = Column(Integer)
+    rate = Column(Float)
+    active = Column(Integer, default=0)
+    tokens = Column(Float)
+    refilled_at = Column(DateTime, default=_now)
+
+    def refill(self, now):
+        """Tokens available at now for a rate limited task name."""
+        elapsed = max((now - self.refilled_at).total_seconds(), 0)
+        return min(max(self.rate, 1.0), self.tokens + elapsed * self.rate)
+
+    def allows(self, now):
+        """True if another task with this name may be claimed."""
+        if (self.max_concurrency is not None and
+            self.active >= self.max_concurrency):
+            return False
+        if self.rate is not None and self.refill(now) < 1:
+            return False
+        return True
+
+    def take(self, now):
+        """Account for a task with this name being claimed."""
+        self.active += 1
+        if self.rate is not None:
+            self.tokens = self.refill(now) - 1
+            self.refilled_at = now
+
+
+def task_destroy(task_id):
+    session = get_session()
+    with session.begin():
+        task_ref = task_get(task_id, session=session)
+        if task_ref.is_active:
+            _limit_adjust(session, task_ref.task_name, -1)
+            task_ref.is_active = False
+        task_ref.delete(session=session)
+
+
+def task_get(task_id, session=None):
+    if not session:
+        session = get_session()
+
+    result = session.query(Task).\
+                     filter_by(id=task_id).\
+                     filter_by(deleted=False).\
+                     first()
+
+    if not result:
+        raise db.TaskNotFound()
+
+    return result
+
+
+_QUERY_COLUMNS = ('id', 'task_name', 'is_active', 'attempts', 'created_at',
+                  'updated_at', 'completed_at')
+
+
+def _filter_tasks(query, task_name=None, state=None, created_before=None,
+                  created_after=None, updated_before=None, completed=None,
+                  active=None):
+    """Restrict a query on tasks to the ones matching the filters."""
+    query = query.filter(Task.deleted == False)
+    if active is not None:
+        query = query.filter(Task.is_active == active)
+    if completed is True:
+        query = query.filter(Task.completed_at != None)
+    elif completed is False:
+        query = query.filter(Task.completed_at == None)
+    if task_name:
+        query = query.filter(Task.task_name == task_name)
+    if state == 'pending':
+        query = query.filter(Task.is_active == False).\
+                      filter(Task.completed_at == None).\
+                      filter(Task.cancelled_at == None).\
+                      filter(Task.attempts == 0)
+    elif state == 'active':
+        query = query.filter(Task.is_active == True).\
+                      filter(Task.completed_at == None).\
+                      filter(Task.cancelled_at == None)
+    elif state == 'failed':
+        query = query.filter(Task.is_active == False).\
+                      filter(Task.completed_at == None).\
+                      filter(Task.cancelled_at == None).\
+                      filter(Task.attempts > 0)
+    elif state == 'complete':
+        query = query.filter(Task.completed_at != None)
+    elif state == 'cancelled':
+        query = query.filter(Task.completed_at == None).\
+                      filter(Task.cancelled_at != None)
+    elif state is not None:
+        raise ValueError('Unknown task state %s' % state)
+    if created_before:
+        query = query.filter(Task.created_at < created_before)
+    if created_after:
+        query = query.filter(Task.created_at >= created_after)
+    if updated_before:
+        query = query.filter(Task.updated_at < updated_before)
+    return query
+
+
+def task_query(columns=None, batch_size=1000, **filters):
+    """Iterate over the tasks matching filters as dicts of columns.
+
+    Pages through the table by id, one batch_size query at a time, so
+    memory use does not grow with the number of matching tasks."""
+    columns = columns or _QUERY_COLUMNS
+    entities = [getattr(Task, column) for column in columns]
+    marker = None
+    while True:
+        session = get_session()
+        query = _filter_tasks(session.query(Task.id, *entities), **filters)
+        if marker is not None:
+            query = query.filter(Task.id > marker)
+        rows = query.order_by(Task.id).limit(batch_size).all()
+        for row in rows:
+            yield dict(zip(columns, row[1:]))
+        if len(rows) < batch_size:
+            return
+        marker = rows[-1][0]
+
+
+def task_update_many(values, task_ids=None, batch_size=1000, **filters):
+    """Apply values to the tasks in task_ids matching filters.
+
+    Every batch of up to batch_size tasks is locked and changed with a
+    single UPDATE in its own transaction.
+
+    :returns: number of tasks updated"""
+    total = 0
+    offset = 0
+    marker = None
+    while True:
+        session = get_session()
+        with session.begin():
+            query = session.query(Task.id, Task.task_name, Task.is_active)
+            query = _filter_tasks(query, **filters)
+            if task_ids is not None:
+                batch = task_ids[offset:offset + batch_size]
+                if not batch:
+                    break
+                query = query.filter(Task.id.in_(batch))
+                offset += batch_size
+            else:
+                if marker is not None:
+                    query = query.filter(Task.id > marker)
+                query = query.order_by(Task.id).limit(batch_size)
+            rows = query.with_lockmode('update').all()
+            if rows:
+                session.query(Task).\
+                        filter(Task.id.in_([row[0] for row in rows])).\
+                        update(values, synchronize_session=False)
+                if 'is_active' in values:
+                    _limit_adjust_rows(session, rows, values['is_active'])
+        total += len(rows)
+        if task_ids is None:
+            if len(rows) < batch_size:
+                break
+            marker = rows[-1][0]
+    return total
+
+
+def task_find_by_key(task_name, idempotency_key):
+    """Get the id of the task created with idempotency_key."""
+    session = get_session()
+    result = session.query(Task.id).\
+                     filter_by(task_name=task_name).\
+                     filter_by(idempotency_key=idempotency_key).\
+                     filter_by(deleted=False).\
+                     scalar()
+
+    if not result:
+        raise db.TaskNotFound()
+
+    return result
+
+
+def task_find_memo(task_name, memo_key, created_after=None):
+    """Get the id and creation time of the newest task with memo_key."""
+    session = get_session()
+    query = session.query(Task.id, Task.created_at).\
+                    filter_by(task_name=task_name).\
+                    filter_by(memo_key=memo_key).\
+                    filter_by(deleted=False).\
+                    filter_by(cancelled_at=None)
+    if created_after:
+        query = query.filter(Task.created_at >= created_after)
+    result = query.order_by(Task.created_at.desc()).first()
+
+    if not result:
+        raise db.TaskNotFound()
+
+    return tuple(result)
+
+
+def task_timeout(time, task_name=None):
+    session = get_session()
+    with session.begin():
+        query = session.query(Task).\
+                        filter(Task.updated_at < time).\
+                        filter_by(is_active=True).\
+                        filter_by(deleted=False).\
+                        filter_by(completed_at=None)
+        if task_name:
+            query = query.filter_by(task_name=task_name)
+        freed = query.with_entities(Task.task_name, func.count(Task.id)).\
+                      group_by(Task.task_name).\
+                      all()
+        result = query.update({Task.is_active: False,
+                               Task.updated_at: _now()},
+                               synchronize_session='fetch')
+        for name, count in freed:
+            _limit_adjust(session, name, -count)
+    return result
+
+
+def task_pop(task_name=None):
+    session = get_session()
+    now = _now()
+    with session.begin():
+        # NOTE(vish): limits are read without locking so claims for
+        #             different names don't queue up behind each other,
+        #             only the row for the name being claimed is locked
+        limits = session.query(TaskLimit)
+        if task_name:
+            limits = limits.filter_by(task_name=task_name)
+        blocked = set(limit_ref.task_name for limit_ref in limits
+                      if not limit_ref.allows(now))
+        while True:
+            query = session.query(Task).\
+                            filter_by(is_active=False).\
+                            filter_by(deleted=False).\
+                            filter_by(completed_at=None).\
+                            filter_by(cancelled_at=None)
+            if task_name:
+                query = query.filter_by(task_name=task_name)
+            if blocked:
+                query = query.filter(~Task.task_name.in_(blocked))
+            task_ref = query.with_lockmode('update').first()
+            # NOTE(vish): if with_lockmode isn't supported, as in sqlite,
+            #             then this has concurrency issues
+            if not task_ref:
+                raise IndexError
+            limit_ref = session.query(TaskLimit).\
+                                filter_by(task_name=task_ref.task_name).\
+                                with_lockmode('update').\
+                                populate_existing().\
+                                first()
+            if not limit_ref:
+                break
+            if limit_ref.allows(now):
+                limit_ref.take(now)
+                break
+            # NOTE(vish): another worker took the last slot since the
+            #             limits were read
+            blocked.add(task_ref.task_name)
+        task_ref.is_active = True
+        session.add(task_ref)
+    return task_ref
+
+
+def task_create(values):
+    task_ref = Task()
+    task_ref.update(values)
+    task_ref.save()
+    return task_ref
+
+
+def task_start(task_id):
+    session = get_session()
+    with session.begin():
+        started = session.query(Task).\
+                          filter_by(id=task_id).\
+                          filter_by(is_active=False).\
+                          update({Task.is_active: True})
+        session.query(Task).\
+                filter_by(id=task_id).\
+                update({Task.attempts: Task.attempts + 1,
+                        Task.updated_at: _now(),
+                        Task.is_active: True})
+        if started:
+            task_name = session.query(Task.task_name).\
+                                filter_by(id=task_id).\
+                                scalar()
+            _limit_adjust(session, task_name, 1)
+
+
+def task_update(task_id, values):
+    session = get_session()
+    with session.begin():
+        task_ref = task_get(task_id, session=session)
+        if 'progress' in values and task_ref.progress_deltas:
+            # NOTE(vish): a full progress write replaces the base snapshot,
+            #             so any deltas recorded on top of the old one
+            #             no longer apply
+            session.query(TaskProgress).\
+                    filter_by(task_id=task_id).\
+                    delete(synchronize_session=False)
+            task_ref.progress_deltas = 0
+        if ('is_active' in values and
+            bool(values['is_active']) != bool(task_ref.is_active)):
+            _limit_adjust(session, task_ref.task_name,
+                          1 if values['is_active'] else -1)
+        task_ref.update(values)
+        task_ref.save(session=session)
+
+
+def task_cancel(task_id):
+    """Flag an incomplete task as cancelled.
+
+    :returns: True if the flag was set"""
+    session = get_session()
+    with session.begin():
+        result = session.query(Task).\
+                         filter_by(id=task_id).\
+                         filter_by(deleted=False).\
+                         filter_by(completed_at=None).\
+                         filter_by(cancelled_at=None).\
+                         update({Task.cancelled_at: _now()},
+                                synchronize_session=False)
+    return result > 0
+
+
+def task_cancelled(task_id):
+    """True if the task has been flagged as cancelled."""
+    session = get_session()
+    result = session.query(Task.cancelled_at).\
+                     filter_by(id=task_id).\
+                     scalar()
+    return result is not None
+
+
+def task_progress_append(task_id, delta):
+    """Record a progress delta for a task.
+
+    :returns: number of deltas recorded since the last full snapshot"""
+    session = get_session()
+    with session.begin():
+        session.query(Task).\
+                filter_by(id=task_id).\
+                update({Task.progress_deltas: Task.progress_deltas + 1,
+                        Task.updated_at: _now()})
+        seq = session.query(Task.progress_deltas).\
+                      filter_by(id=task_id).\
+                      scalar()
+        if seq is None:
+            raise db.TaskNotFound()
+        session.add(TaskProgress(task_id=task_id, seq=seq, delta=delta))
+    return seq
+
+
+def task_progress_deltas(task_id):
+    """Get the deltas recorded for a task in the order they were applied."""
+    session = get_session()
+    query = session.query(TaskProgress.delta).\
+                    filter_by(task_id=task_id).\
+                    order_by(TaskProgress.seq)
+    return [row[0] for row in query]
+
+
+def _limit_adjust(session, task_name, delta):
+    """Adjust the active counter for task_name if it is limited."""
+    query = session.query(TaskLimit).filter_by(task_name=task_name)
+    query.update({TaskLimit.active: TaskLimit.active + delta},
+                 synchronize_session=False)
+    if delta < 0:
+        query.filter(TaskLimit.active < 0).\
+              update({TaskLimit.active: 0}, synchronize_session=False)
+
+
+def _limit_adjust_rows(session, rows, is_active):
+    """Adjust active counters for (id, task_name, is_active) rows."""
+    changed = {}
+    for _id, task_name, was_active in rows:
+        if bool(was_active) != bool(is_active):
+            changed[task_name] = changed.get(task_name, 0) + 1
+    for task_name, count in changed.iteritems():
+        _limit_adjust(session, task_name, count if is_active else -count)
+
+
+def task_limit_set(task_name, max_concurrency=None, rate=None):
+    """Create or change the claim limits for task_name."""
+    session = get_session()
+    try:
+        with session.begin():
+            limit_ref = session.query(TaskLimit).\
+                                filter_by(task_name=task_name).\
+                                with_lockmode('update').\
+                                first()
+            if not limit_ref:
+                # NOTE(vish): tasks with this name may already be running
+                active = session.query(func.count(Task.id)).\
+                                 filter_by(task_name=task_name).\
+                                 filter_by(is_active=True).\
+                                 filter_by(deleted=False).\
+                                 filter_by(completed_at=None).\
+                                 scalar()
+                limit_ref = TaskLimit(task_name=task_name, active=active)
+                limit_ref.tokens = max(rate or 0, 1.0)
+            limit_ref.max_concurrency = max_concurrency
+            limit_ref.rate = rate
+            session.add(limit_ref)
+    except exc.IntegrityError:
+        # NOTE(vish): another process created the limits first
+        task_limit_set(task_name, max_concurrency, rate)
+
+
+def task_limit_clear(task_name):
+    """Remove the claim limits for task_name."""
+    session = get_session()
+    with session.begin():
+        session.query(TaskLimit).\
+                filter_by(task_name=task_name).\
+                delete(synchronize_session=False)
@@ -16,6 +16,10 @@
 #    under the License.
 
 import datetime
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
 import mock_datetime
@@ -83,6 +87,46 @@ def complex_task(number, *args, **kwargs):
     for x in xrange(progress, number):
         yield x
 
+@task.ify(delta_progress=True, compact_every=4)
+def delta_task(number, fail_at=None, **kwargs):
+    task_id = kwargs.pop('task_id')
+    progress = kwargs.pop('progress')
+    first_run = progress is None
+    progress = progress or {'done': set(), 'last': None}
+    for x in xrange(number):
+        if x in progress['done']:
+            continue
+        if x == fail_at and first_run:
+            raise Exception('fail')
+        progress['done'].add(x)
+        progress['last'] = x
+        yield progress
+
+@task.ify(max_concurrency=1)
+def serial(task_id, progress):
+    return task_id
+
+@task.ify(rate=1)
+def throttled(task_id, progress):
+    return task_id
+
+@task.ify(dedupe_key=lambda number, **kwargs: number)
+def deduped(number, task_id, progress):
+    return number
+
+@task.ify()
+def square(number, task_id, progress):
+    if number in square.fail:
+        square.fail.remove(number)
+        raise task.Failure(number)
+    return number * number
+
+square.fail = set()
+
+@task.ify(memoize=True, ttl=60)
+def memoized(*args, **kwargs):
+    return args
+
 class ObjectWithTasks(object):
     def __init__(self, value):
         super(ObjectWithTasks, self).__init__()
@@ -175,6 +219,23 @@ class TaskTestCase(unittest.TestCase):
         rval = task.run(task_id)
         self.assertEqual(total, sum(list(rval)))
 
+    def test_delta_progress(self):
+        task_id = delta_task(10, fail_at=6)
+        rval = task.run(task_id)
+        self.assertEqual(list(rval)[-1]['last'], 5)
+        self.assertFalse(task.is_complete(task_id))
+        self.assertEqual(task.get(task_id)['progress']['last'], 3)
+        self.assertEqual(task.get(task_id)['progress_deltas'], 2)
+        progress = task.get_progress(task_id)
+        self.assertEqual(progress['done'], set(xrange(6)))
+        self.assertEqual(progress['last'], 5)
+        rval = task.run(task_id)
+        self.assertEqual([p['last'] for p in rval], range(6, 10))
+        self.assertTrue(task.is_complete(task_id))
+        self.assertEqual(task.get(task_id)['progress_deltas'], 0)
+        self.assertEqual(task.get(task_id)['progress']['done'],
+                         set(xrange(10)))
+
     def test_object_retry(self):
         obj = ObjectWithTasks(42)
         task_id = obj.retry_value()
@@ -238,3 +299,390 @@ class TaskTestCase(unittest.TestCase):
             self.assertFalse(task.is_complete(task_id3))
         finally:
             mock_datetime.clear_time_override()
+
+    def test_claim_max_concurrency(self):
+        task_id1 = serial()
+        task_id2 = serial()
+        task_id3 = finish()
+        self.assertEqual(task.claim(), task_id1)
+        self.assertEqual(task.claim(), task_id3)
+        self.assertEqual(task.claim(), None)
+        task.run(task_id1)
+        self.assertEqual(task.claim(), task_id2)
+
+    def test_claim_max_concurrency_timeout(self):
+        mock_datetime.set_time_override()
+        try:
+            task_id1 = serial()
+            task_id2 = serial()
+            self.assertEqual(task.claim(), task_id1)
+            self.assertEqual(task.claim(), None)
+            mock_datetime.advance_time_seconds(60)
+            timeout = mock_datetime.utcnow() - datetime.timedelta(seconds=30)
+            self.assertEqual(task.timeout(timeout), 1)
+            self.assertEqual(task.claim(), task_id1)
+            self.assertEqual(task.claim(), None)
+        finally:
+            mock_datetime.clear_time_override()
+
+    def test_claim_max_concurrency_destroy(self):
+        task_id1 = serial()
+        task_id2 = serial()
+        self.assertEqual(task.claim(), task_id1)
+        self.assertEqual(task.claim(), None)
+        task.db.task_destroy(task_id1)
+        self.assertEqual(task.claim(), task_id2)
+
+    def test_limits_seeded_from_running_tasks(self):
+        task_id1 = finish()
+        task_id2 = finish()
+        self.assertEqual(task.claim(), task_id1)
+        task.db.task_limit_set('finish', max_concurrency=1)
+        self.assertEqual(task.claim(), None)
+        task.run(task_id1)
+        self.assertEqual(task.claim(), task_id2)
+
+    def test_limits_cleared_without_limits(self):
+        task.db.task_limit_set('finish', max_concurrency=0)
+        task_id = finish()
+        self.assertEqual(task.claim(), task_id)
+
+    def test_claim_rate(self):
+        mock_datetime.set_time_override()
+        try:
+            task_id1 = throttled()
+            task_id2 = throttled()
+            self.assertEqual(task.claim(), task_id1)
+            self.assertEqual(task.claim(), None)
+            mock_datetime.advance_time_seconds(0.5)
+            self.assertEqual(task.claim(), None)
+            mock_datetime.advance_time_seconds(0.5)
+            self.assertEqual(task.claim(), task_id2)
+        finally:
+            mock_datetime.clear_time_override()
+
+    def test_idempotency_key(self):
+        task_id = retry(1, idempotency_key='abc')
+        self.assertEqual(retry(2, idempotency_key='abc'), task_id)
+        self.assertNotEqual(retry(1, idempotency_key='def'), task_id)
+        self.assertNotEqual(retry(1), retry(1))
+        self.assertNotEqual(finish(idempotency_key='abc'), task_id)
+        self.assertEqual(task.get(task_id)['args'], (1,))
+
+    def test_idempotency_key_after_destroy(self):
+        task_id1 = retry(idempotency_key='abc')
+        task.db.task_destroy(task_id1)
+        task_id2 = retry(idempotency_key='abc')
+        self.assertNotEqual(task_id2, task_id1)
+        self.assertEqual(retry(idempotency_key='abc'), task_id2)
+        task.destroy_many([task_id2])
+        task_id3 = retry(idempotency_key='abc')
+        self.assertNotEqual(task_id3, task_id2)
+        self.assertTrue(task.exists(task_id3))
+
+    def test_dedupe_key(self):
+        task_id = deduped(1)
+        self.assertEqual(deduped(1), task_id)
+        self.assertNotEqual(deduped(2), task_id)
+        self.assertEqual(deduped(2, idempotency_key=1), task_id)
+
+    def test_duplicate_key_insert(self):
+        retry(idempotency_key='abc')
+        values = {'id': 'other', 'task_name': 'retry',
+                  'idempotency_key': 'abc'}
+        self.assertRaises(task.db.Duplicate, task.db.task_create, values)
+
+    def test_map(self):
+        square.fail = set([4])
+        task_ids = square.map(iter(xrange(7)), chunk_size=3)
+        self.assertEqual(len(task_ids), 3)
+        self.assertEqual(task.get(task_ids[2])['args'][1], [6])
+        for task_id in task_ids:
+            list(task.run(task_id))
+        self.assertFalse(task.is_complete(task_ids[1]))
+        self.assertEqual(task.get_progress(task_ids[1]), {0: 9})
+        results = task.gather(task_ids)
+        self.assertEqual([results.next() for x in xrange(3)], [0, 1, 4])
+        self.assertRaises(task.NotComplete, results.next)
+        self.assertEqual(list(task.run(task_ids[1]))[-1], {0: 9, 1: 16, 2: 25})
+        self.assertTrue(task.is_complete(task_ids[1]))
+        self.assertEqual(list(task.gather(task_ids)),
+                         [x * x for x in xrange(7)])
+
+    def test_map_rejects_generators(self):
+        self.assertRaises(TypeError, complex_task.map, xrange(5))
+
+    def test_map_rejects_methods(self):
+        obj = ObjectWithTasks(42)
+        self.assertRaises(TypeError, obj.retry_value.map, xrange(5))
+
+    def test_map_idempotency_key(self):
+        task_ids = square.map(xrange(5), chunk_size=2, idempotency_key='sq')
+        self.assertEqual(square.map(xrange(5), chunk_size=2,
+                                    idempotency_key='sq'), task_ids)
+
+    def test_query(self):
+        mock_datetime.set_time_override()
+        try:
+            active = retry()
+            task.claim()
+            finished = finish()
+            task.run(finished)
+            failed = retry()
+            task.run(failed)
+            mock_datetime.advance_time_seconds(30)
+            cutoff = mock_datetime.utcnow()
+            mock_datetime.advance_time_seconds(30)
+            pending = [retry() for x in xrange(5)]
+        finally:
+            mock_datetime.clear_time_override()
+        ids = lambda **kwargs: set(t['id'] for t in task.query(**kwargs))
+        self.assertEqual(ids(), set(pending + [finished, failed, active]))
+        self.assertEqual(ids(state='complete'), set([finished]))
+        self.assertEqual(ids(state='failed'), set([failed]))
+        self.assertEqual(ids(state='active'), set([active]))
+        self.assertEqual(ids(state='pending', batch_size=2), set(pending))
+        self.assertEqual(ids(task_name='retry', batch_size=1),
+                         set(pending + [failed, active]))
+        self.assertEqual(ids(created_before=cutoff),
+                         set([finished, failed, active]))
+        rows = list(task.query(state='failed', columns=['task_name']))
+        self.assertEqual(rows, [{'task_name': 'retry'}])
+        self.assertRaises(ValueError, list, task.query(state='unknown'))
+
+    def test_memoize(self):
+        mock_datetime.set_time_override()
+        try:
+            task_id = memoized(1, {'a': 1, 'b': set([2, 3])}, c=4)
+            task.run(task_id)
+            self.assertEqual(memoized(1, {'b': set([3, 2]), 'a': 1}, c=4),
+                             task_id)
+            self.assertNotEqual(memoized(1, {'a': 1}, c=4), task_id)
+            task._memo_cache.clear()
+            mock_datetime.advance_time_seconds(30)
+            self.assertEqual(memoized(1, {'a': 1, 'b': set([2, 3])}, c=4),
+                             task_id)
+            mock_datetime.advance_time_seconds(31)
+            self.assertNotEqual(memoized(1, {'a': 1, 'b': set([2, 3])}, c=4),
+                                task_id)
+        finally:
+            mock_datetime.clear_time_override()
+
+    def test_import_is_lazy(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = subprocess.call([sys.executable, '-c',
+                                "import sys, task; task.setup_db('sqlite://'); "
+                                "sys.exit('sqlalchemy' in sys.modules)"],
+                               cwd=root)
+        self.assertEqual(code, 0)
+
+    def test_schema_created_once(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        api = task.db._impl()
+        create_all = api.BASE.metadata.create_all
+        calls = []
+        def counting_create_all(*args, **kwargs):
+            calls.append(args)
+            return create_all(*args, **kwargs)
+        api.BASE.metadata.create_all = counting_create_all
+        try:
+            task.setup_db('sqlite:///' + path)
+            task_id = finish()
+            task.setup_db('sqlite:///' + path)
+            self.assertTrue(task.exists(task_id))
+            self.assertEqual(len(calls), 1)
+        finally:
+            api.BASE.metadata.create_all = create_all
+            os.remove(path)
+
+    def test_finish_and_fail_many(self):
+        task_ids = [serial() for x in xrange(5)]
+        other = finish()
+        self.assertEqual(task.claim(), task_ids[0])
+        self.assertEqual(task.fail_many(task_ids[:2]), 2)
+        self.assertFalse(task.is_active(task_ids[0]))
+        self.assertEqual(task.claim(), task_ids[0])
+        self.assertEqual(task.finish_many(task_name='serial', batch_size=2),
+                         5)
+        self.assertTrue(all(task.is_complete(t) for t in task_ids))
+        self.assertFalse(task.is_complete(other))
+        self.assertEqual(task.finish_many(task_ids), 0)
+        self.assertEqual(task.claim(), other)
+        self.assertRaises(ValueError, task.finish_many)
+
+    def test_requeue_skips_running_tasks(self):
+        task_id1 = serial()
+        task_id2 = serial()
+        task.run(task_id2)
+        self.assertEqual(task.claim(), task_id1)
+        self.assertEqual(task.requeue(task_name='serial'), 1)
+        self.assertEqual(task.requeue([task_id1]), 0)
+        self.assertTrue(task.is_active(task_id1))
+        self.assertEqual(task.claim(), None)
+        self.assertEqual(task.requeue(task_name='serial', state='active'), 1)
+        self.assertFalse(task.is_active(task_id1))
+        self.assertEqual(task.claim(), task_id1)
+
+    def test_destroy_many_and_requeue(self):
+        failed = [retry() for x in xrange(3)]
+        for task_id in failed:
+            task.run(task_id)
+        finished = finish()
+        task.run(finished)
+        self.assertEqual(task.requeue(state='failed', task_name='retry',
+                                      batch_size=2), 3)
+        self.assertEqual(len(list(task.query(state='pending'))), 3)
+        self.assertEqual(task.requeue([finished]), 1)
+        self.assertFalse(task.is_complete(finished))
+        self.assertEqual(task.destroy_many(failed[1:]), 2)
+        self.assertFalse(task.exists(failed[1]))
+        self.assertTrue(task.exists(failed[0]))
+        self.assertEqual(task.destroy_many(task_name='retry'), 1)
+        self.assertFalse(task.exists(failed[0]))
+
+    def test_cancel_running_task(self):
+        task_id = complex_task(10)
+        rval = task.run(task_id)
+        self.assertEqual(rval.next(), 0)
+        self.assertTrue(task.cancel(task_id))
+        self.assertFalse(task.cancel(task_id))
+        self.assertRaises(StopIteration, rval.next)
+        self.assertTrue(task.is_cancelled(task_id))
+        self.assertFalse(task.is_active(task_id))
+        self.assertFalse(task.is_complete(task_id))
+        self.assertEqual(task.get_progress(task_id), 0)
+        self.assertEqual(task.claim(), None)
+        self.assertRaises(task.Cancelled, task.run, task_id)
+        self.assertEqual([t['id'] for t in task.query(state='cancelled')],
+                         [task_id])
+
+    def test_cancel_check_is_cached(self):
+        interval = task.CANCEL_CHECK_INTERVAL
+        task.CANCEL_CHECK_INTERVAL = 3600
+        try:
+            task_id = complex_task(10)
+            rval = task.run(task_id)
+            rval.next()
+            rval.next()
+            task.cancel(task_id)
+            self.assertEqual(rval.next(), 2)
+            self.assertTrue(task.is_active(task_id))
+        finally:
+            task.CANCEL_CHECK_INTERVAL = interval
+
+    def test_cancel_pending_task(self):
+        task_id1 = finish()
+        task_id2 = finish()
+        self.assertTrue(task.cancel(task_id1))
+        self.assertEqual(task.claim(), task_id2)
+        self.assertEqual(task.claim(), None)
+        self.assertEqual(task.requeue([task_id1]), 1)
+        self.assertFalse(task.is_cancelled(task_id1))
+        self.assertEqual(task.claim(), task_id1)
+
+    def test_cancel_claimed_task(self):
+        task_id1 = serial()
+        task_id2 = serial()
+        self.assertEqual(task.claim(), task_id1)
+        task.cancel(task_id1)
+        self.assertRaises(task.Cancelled, task.run, task_id1)
+        self.assertFalse(task.is_active(task_id1))
+        self.assertEqual(task.claim(), task_id2)
+
+    def test_cancel_completed_task(self):
+        task_id = finish()
+        task.run(task_id)
+        self.assertFalse(task.cancel(task_id))
+        self.assertFalse(task.is_cancelled(task_id))
+
+    def test_memoize_cache_window(self):
+        seconds = task.MEMO_CACHE_SECONDS
+        try:
+            task.MEMO_CACHE_SECONDS = 3600
+            task_id = memoized(1)
+            task.db.task_destroy(task_id)
+            # NOTE(vish): cached hits are trusted for the whole window
+            self.assertEqual(memoized(1), task_id)
+            task.MEMO_CACHE_SECONDS = 0
+            task_id = memoized(2)
+            task.destroy_many([task_id])
+            task_id2 = memoized(2)
+            self.assertNotEqual(task_id2, task_id)
+            self.assertTrue(task.exists(task_id2))
+        finally:
+            task.MEMO_CACHE_SECONDS = seconds
+
+    def test_memoize_expired_entry_checks_db(self):
+        mock_datetime.set_time_override()
+        try:
+            task_id = memoized(1)
+            mock_datetime.advance_time_seconds(61)
+            # NOTE(vish): another process memoized a newer matching task
+            key = task._memo_key((1,), {})
+            newer = task._create('memoized', memoized, False, (1,), {},
+                                 memo_key=key)
+            self.assertEqual(memoized(1), newer)
+            self.assertNotEqual(newer, task_id)
+        finally:
+            mock_datetime.clear_time_override()
+
+    def _old_schema_db(self, exclude, version=None):
+        """Create a db file whose tasks table lacks the excluded columns."""
+        import sqlalchemy
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        api = task.db._impl()
+        engine = sqlalchemy.create_engine('sqlite:///' + path)
+        metadata = sqlalchemy.MetaData()
+        tasks = sqlalchemy.Table('tasks', metadata,
+                                 *[column.copy() for column
+                                   in api.Task.__table__.columns
+                                   if column.name not in exclude])
+        metadata.create_all(engine)
+        engine.execute(tasks.insert(), id='old', task_name='old',
+                       deleted=False, is_active=False, attempts=0)
+        if version is not None:
+            api.SchemaVersion.__table__.create(engine)
+            engine.execute(api.SchemaVersion.__table__.insert(),
+                           version=version)
+        return 'sqlite:///' + path
+
+    def test_schema_upgrade_unversioned(self):
+        task.setup_db(self._old_schema_db(['progress_deltas',
+                                           'idempotency_key', 'memo_key',
+                                           'cancelled_at']))
+        self.assertTrue(task.exists('old'))
+        self.assertEqual(task.get('old')['progress_deltas'], 0)
+        task_id = retry(idempotency_key='abc')
+        self.assertEqual(retry(idempotency_key='abc'), task_id)
+        self.assertEqual(memoized(1), memoized(1))
+        task_id = delta_task(3)
+        list(task.run(task_id))
+        self.assertTrue(task.is_complete(task_id))
+
+    def test_schema_upgrade_from_version_1(self):
+        task.setup_db(self._old_schema_db(['cancelled_at'], version=1))
+        self.assertEqual(task.claim(), 'old')
+        self.assertFalse(task.is_cancelled('old'))
+        task_id = finish()
+        self.assertTrue(task.cancel(task_id))
+        self.assertEqual(task.claim(), None)
+
+    def test_schema_version_race(self):
+        url = self._old_schema_db([], version=None)
+        task.setup_db(url)
+        self.assertTrue(task.exists('old'))
+        api = task.db._impl()
+        schema_version = api._schema_version
+        # NOTE(vish): a second process that checked the version before the
+        #             first one recorded it
+        api._schema_version = lambda engine: None
+        try:
+            import sqlalchemy
+            api._sync_schema(sqlalchemy.create_engine(url))
+        finally:
+            api._schema_version = schema_version
+        task.setup_db(url)
+        self.assertTrue(task.exists('old'))